@@ -2,29 +2,54 @@
 # author: joe.zheng
 
 import argparse
+import errno
+import functools
+import hashlib
 import logging
 import json
 import os
+import pickle
 import re
 import sys
 import shutil
-import zipfile
+import threading
+import time
 
+from bisect import bisect_left, bisect_right
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-from urllib.request import urlopen
-from urllib.error import URLError
-
-# hack here to ensure the current locale supports unicode correctly
-import locale
-if locale.getpreferredencoding() != 'UTF-8':
-    locale.setlocale(locale.LC_CTYPE, 'en_US.UTF-8')
+from operator import itemgetter
+from urllib.error import HTTPError, URLError
+
+try:
+    # optional, to parse the index incrementally
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    # optional, to parse the index faster
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # not on Windows, to clone the files
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.INFO)
 
 
+@functools.lru_cache(maxsize=256)
+def compile_pattern(pattern):
+    # case insensitive, cached to avoid recompiling for repeated searches
+    return re.compile(pattern, flags=re.I)
+
+
 class Progress:
     file = sys.stderr
     width = 32
@@ -33,14 +58,24 @@ class Progress:
     bar_suffix = '| '
     empty_fill = ' '
     fill = '#'
+    interval = 1 / 30
 
     def __init__(self, message='', max=100, **kwargs):
         self.index = 0
         self.max = max
+        self._last_time = 0
+        self._last_line = ''
+        self._last_state = None
         for key, val in kwargs.items():
             setattr(self, key, val)
 
         self.message = message
+        # sliced for each draw, rather than built by repeating each time
+        self._full = self.fill * self.width
+        self._empty = self.empty_fill * self.width
+        # the bar is for the eyes only, not for the pipes or files
+        if self.file and not self.file.isatty():
+            self.file = None
 
     def __getitem__(self, key):
         if key.startswith('_'):
@@ -60,16 +95,30 @@ class Progress:
         return self.progress * 100
 
     def update(self):
-        filled_length = int(self.width * self.progress)
-        empty_length = self.width - filled_length
+        if not self.file:
+            return
 
-        message = self.message % self
-        bar = self.fill * filled_length
-        empty = self.empty_fill * empty_length
-        suffix = self.suffix % self
-        line = ''.join([message, self.bar_prefix, bar, empty, self.bar_suffix,
-                        suffix])
-        self.writeln(line)
+        # no need to redraw faster than the eyes can follow
+        now = time.monotonic()
+        if now - self._last_time < self.interval and self.index < self.max:
+            return
+
+        # integer math, cheaper than the float progress
+        filled_length = min(self.width * self.index // self.max, self.width)
+        # nothing visible changed, skip the formatting
+        state = (filled_length, 100 * self.index // self.max)
+        if state == self._last_state:
+            return
+        self._last_state = state
+
+        line = ''.join([self.message % self, self.bar_prefix,
+                        self._full[:filled_length],
+                        self._empty[filled_length:],
+                        self.bar_suffix, self.suffix % self])
+        if line != self._last_line:
+            self._last_time = now
+            self._last_line = line
+            self.writeln(line)
 
     def start(self):
         self.update()
@@ -80,6 +129,9 @@ class Progress:
             self.file.flush()
 
     def finish(self):
+        # draw the last state in case it was skipped
+        self._last_time = 0
+        self.update()
         if self.file:
             print(file=self.file)
 
@@ -95,22 +147,47 @@ class Progress:
         self.finish()
 
 
+# bump it when the layout of the index cache changes
+INDEX_CACHE_VERSION = 4
+
+
 class Repo:
     def __init__(self, index_url='http://localhost:3000/index.json', root_dir='app'):
-        logger.debug("index_url: " + index_url + ", root: " + root_dir)
+        logger.debug("index_url: %s, root: %s", index_url, root_dir)
 
         self.index_url = index_url
         self.repo_url = index_url[:index_url.rindex('/')+1]
-        logger.debug("repo_url: " + self.repo_url)
+        logger.debug("repo_url: %s", self.repo_url)
 
         # the local repository
         self.root_dir = root_dir
         self.cache_dir = os.path.join(self.root_dir, 'cache')
         self.installed_dir = os.path.join(self.root_dir, 'installed')
         self.index_file = os.path.join(self.cache_dir, 'index.json')
+        # the parsed index, out of the cache dir to not be served
+        self.index_cache = os.path.join(self.root_dir, 'index.pkl')
+
+        # download the apk by several ranges in parallel if it is larger
+        self.split_size = 1024 * 1024 * 16
+        self.split_parts = 4
+        # the apks to download at the same time, to size the connection pool
+        self.jobs = 1
+        # the requests session to reuse the connections, created on demand,
+        # False if requests is not available
+        self.http = None
+        self.http_lock = threading.Lock()
+        # where to draw the progress bars, None to draw none
+        self.progress_file = Progress.file
 
         # the loaded index, apk name is the dict key
         self.index = {}
+        # the index may be empty even after it is loaded
+        self.index_loaded = False
+        # the text to be searched for each apk in lower case,
+        # apk name is the dict key, built on demand
+        self.haystack = None
+        # the names sorted in lower case, built on demand
+        self.sorted_names = None
 
         # see also: libcore/libart/src/main/java/dalvik/system/VMRuntime.java
         self.abi2isa = {'x86': 'x86', 'x86_64': 'x86_64', 'armeabi': 'arm',
@@ -121,26 +198,21 @@ class Repo:
 
     def _ensure_dirs(self):
         for d in (self.root_dir, self.cache_dir, self.installed_dir):
-            if not os.path.exists(d):
-                os.makedirs(d)
+            os.makedirs(d, exist_ok=True)
 
     def _ensure_parent_dir(self, path):
         d = os.path.dirname(path)
-        if d and not os.path.exists(d):
-            os.makedirs(d)
+        if d:
+            # may be called from several download threads at the same time
+            os.makedirs(d, exist_ok=True)
 
     def _ensure_index(self):
-        if not self.index:
+        if not self.index_loaded:
             if not self._load_index():
                 if not self.update():
                     raise RuntimeError(
                         "apk index can't be loaded successfully")
 
-    def _remote_url(self, name):
-        info = self.get_info(name)
-        if info and 'path' in info:
-            return os.path.join(self.repo_url, info['path'])
-
     def _cached_path(self, name):
         info = self.get_info(name)
         if info and 'path' in info:
@@ -149,120 +221,419 @@ class Repo:
     def _installed_path(self, name):
         return os.path.join(self.installed_dir, name, name + '.apk')
 
+    def _get_http(self):
+        # may be called from several download threads at the same time
+        with self.http_lock:
+            if self.http is None:
+                try:
+                    import requests
+                except ImportError:
+                    self.http = False
+                else:
+                    self.http = requests.Session()
+                    # one connection kept for each range of each of the
+                    # parallel downloads, the extra ones are dropped after use
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=4,
+                        pool_maxsize=max(1, self.jobs) * self.split_parts)
+                    self.http.mount('http://', adapter)
+                    self.http.mount('https://', adapter)
+                    # the same as urlopen, apk is compressed already
+                    self.http.headers['Accept-Encoding'] = 'identity'
+        return self.http
+
+    @contextmanager
+    def _urlopen(self, url, headers=None):
+        # keep the connections alive by requests if it is available,
+        # the handshakes add up when fetching lots of apks from one server
+        http = url.startswith(('http://', 'https://')) and self._get_http()
+        if http:
+            import requests
+            import urllib3
+            try:
+                res = http.get(url, headers=headers, stream=True, timeout=30)
+            except requests.RequestException as e:
+                raise URLError(e)
+            if not res.ok:
+                # the same error as urlopen, so the status can be checked
+                res.close()
+                raise HTTPError(url, res.status_code, res.reason,
+                                res.headers, None)
+            with res:
+                try:
+                    yield res.raw
+                except (requests.RequestException,
+                        urllib3.exceptions.HTTPError) as e:
+                    # broken while reading, the same error as the others
+                    raise URLError(e)
+        else:
+            from http.client import HTTPException
+            from urllib.request import Request, urlopen
+            with urlopen(Request(url, headers=headers or {})) as res:
+                try:
+                    yield res
+                except (HTTPException, ConnectionError, TimeoutError) as e:
+                    raise URLError(e)
+
     def _get_cached(self, name):
-        dst = self._cached_path(name)
-        if dst:
-            if self.is_cached(name):
+        # look up the info once, rather than once in each helper
+        info = self.get_info(name)
+        if info and 'path' in info:
+            dst = os.path.join(self.cache_dir, info['path'])
+            if self._check_cached(info, dst):
+                return dst
+            # it is a URL, not a local path, repo_url ends with '/'
+            src = self.repo_url + info['path']
+            if self._download(src, dst, info.get('size'), info.get('sha256')):
                 return dst
-            else:
-                src = self._remote_url(name)
-                size, info = None, self.get_info(name)
-                if info and 'size' in info:
-                    size = info['size']
-                if src and self._download(src, dst, size=size):
-                    return dst
 
-    def is_cached(self, name):
-        path = self._cached_path(name)
-        if path and os.path.exists(path):
-            # check the cached file is valid by file size
-            # SHA256 or MD5 is too heavy for such a simple case
-            info = self.get_info(name)
-            if info and 'size' in info:
-                if os.path.getsize(path) == info['size']:
-                    return True
+    def _check_cached(self, info, path, read=True):
+        if 'size' in info:
+            # check the cached file is valid by file size first,
+            # then by the digest if the index has it
+            try:
+                if os.stat(path).st_size != info['size']:
+                    return False
+            except FileNotFoundError:
+                return False
+            if 'sha256' not in info:
+                return True
+            # read=False to trust the digest cached by file_sha256, without
+            # reading the file, the size is all to check if there is none
+            digest = file_sha256(path, read)
+            return digest is None or digest == info['sha256']
         return False
 
+    def _is_cached(self, info, read=True):
+        if info and 'path' in info:
+            return self._check_cached(
+                info, os.path.join(self.cache_dir, info['path']), read)
+        return False
+
+    def is_cached(self, name):
+        return self._is_cached(self.get_info(name))
+
     def is_installed(self, name):
         return os.path.exists(self._installed_path(name))
 
-    def _download(self, src, dst, size=None):
-        chunk = 1024 * 256
+    def _installed_names(self):
+        # one directory listing instead of checking the apks one by one
+        try:
+            with os.scandir(self.installed_dir) as it:
+                return {e.name for e in it if e.is_dir()}
+        except FileNotFoundError:
+            return set()
+
+    def _download(self, src, dst, size=None, sha256=None):
+        chunk = 1024 * 1024
+        prompt = "downloading " + os.path.basename(dst)
+        # download to another file first, so dst is always a complete one,
+        # and resume the one left by the last interrupted download
+        part = dst + '.part'
+        done = 0
+        headers = None
+        if size:
+            try:
+                done = os.stat(part).st_size
+            except FileNotFoundError:
+                pass
+        if done:
+            # resume only if the remote one is known to be the same one, by
+            # If-Range on the server, or by the digest after all
+            validator = load_validator(part)
+            if done >= size or not (validator or sha256):
+                done = 0
+            else:
+                headers = {'Range': 'bytes={}-'.format(done)}
+                if validator:
+                    headers['If-Range'] = validator
+        # hash the data on the way to the disk, not to read it back again
+        hasher = hashlib.sha256() if sha256 else None
         try:
-            with urlopen(src) as res:
-                logger.debug(str(res.info()))
+            with self._urlopen(src, headers) as res:
+                logger.debug("%s", res.headers)
+                if getattr(res, 'status', None) != 206:
+                    # the range is ignored or the file is changed, start
+                    # over, not to keep anything of the stale one
+                    done = 0
+                    remove_file(part)
                 self._ensure_parent_dir(dst)
-                length = res.length if size is None else size
-                blocks = max(length // chunk, 1)
-                prompt = "downloading " + os.path.basename(dst)
-                with Progress(message=prompt, max=blocks) as bar:
-                    with open(dst, 'wb') as f:
+                length = size
+                if length is None:
+                    length = int(res.headers.get('Content-Length') or 0)
+                if not length:
+                    # unknown size, no progress to show, just copy it
+                    with open(part, 'wb') as f:
+                        copy_stream(res, f, chunk, hasher=hasher)
+                elif (not done and length >= self.split_size and
+                        hasattr(os, 'pwrite') and
+                        res.headers.get('Accept-Ranges') == 'bytes'):
+                    # large enough to fetch several ranges at the same time,
+                    # written by offset, os.pwrite is not on Windows
+                    res.close()
+                    if not self._download_ranges(src, part, length, prompt):
+                        return False
+                    # the ranges come out of order, hash the file instead
+                    hasher = None
+                else:
+                    with Progress(message=prompt, max=length,
+                                  file=self.progress_file) as bar:
+                        with open(part, 'r+b' if done else 'wb') as f:
+                            if done:
+                                logger.debug("resume %s from %d", src, done)
+                                if hasher:
+                                    copy_stream(f, None, chunk, hasher=hasher)
+                                f.seek(done)
+                                bar.next(done)
+                            else:
+                                # to tell it is the same one when resuming
+                                validator = get_validator(res.headers)
+                                if validator:
+                                    save_validator(part, validator)
+                            copy_stream(res, f, chunk, bar, hasher)
+        except URLError as e:
+            if headers and isinstance(e, HTTPError):
+                # the range is rejected, e.g. 416 as the file got smaller,
+                # what is left can't be resumed at all, start over
+                logger.debug("can't resume %s: %s", src, e)
+                remove_file(part)
+                return self._download(src, dst, size, sha256)
+            logger.warning('error to download %s: %s', src, e)
+            return False
+        if sha256:
+            if hasher:
+                digest = hasher.hexdigest()
+                save_sha256(part, digest)
+            else:
+                digest = file_sha256(part)
+            if digest != sha256:
+                logger.warning('checksum mismatch, corrupted: %s', dst)
+                os.unlink(part)
+                return False
+        os.replace(part, dst)
+        return True
+
+    def _download_ranges(self, src, dst, length, prompt):
+        chunk = 1024 * 1024
+        parts = self.split_parts
+        step = -(-length // parts)
+        lock = threading.Lock()
+        with Progress(message=prompt, max=length,
+                      file=self.progress_file) as bar:
+            with open(dst, 'wb') as f:
+                f.truncate(length)
+                fd = f.fileno()
+
+                def fetch(start):
+                    end = min(start + step, length) - 1
+                    headers = {'Range': 'bytes={}-{}'.format(start, end)}
+                    with self._urlopen(src, headers) as res:
+                        if res.status != 206:
+                            raise URLError('range request is not supported')
+                        buf = memoryview(bytearray(chunk))
+                        offset = start
                         while True:
-                            data = res.read(chunk)
-                            if not data:
+                            n = res.readinto(buf)
+                            if not n:
                                 break
-                            f.write(data)
-                            bar.next()
-            return True
-        except URLError as e:
-            logger.warning('error to download ' + src + ': ' + str(e))
-
-    def _deploy_lib(self, apk, abis):
-        d = os.path.dirname(apk)
-        with zipfile.ZipFile(apk) as zf:
-            for f in zf.namelist():
-                if f.startswith('lib/'):
-                    zf.extract(f, d)
-        # convert ABI to ISA
+                            os.pwrite(fd, buf[:n], offset)
+                            offset += n
+                            with lock:
+                                bar.next(n)
+                    return offset - start
+
+                with ThreadPoolExecutor(max_workers=parts) as ex:
+                    received = sum(ex.map(fetch, range(0, length, step)))
+        return received == length
+
+    def _extract(self, zf, info, path):
+        # similar with ZipFile.extract, but stream with a larger buffer,
+        # the parent dir should have been created
+        if not info.file_size:
+            # nothing to inflate, skip the member header read
+            open(path, 'wb').close()
+            return
+        with zf.open(info) as src, open(path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def _plan_lib(self, zf, abis):
+        # group the libs by ABI, and map each wanted ABI to its ISA dir,
+        # in the order of self.abis, if several map to the same ISA,
+        # the first one wins, so the others are not extracted at all
+        libs = {}
+        for i in zf.infolist():
+            if i.filename.startswith('lib/') and not i.is_dir():
+                parts = i.filename.split('/')
+                if '..' in parts:
+                    logger.warning("invalid path %s, skip", i.filename)
+                elif len(parts) > 2:
+                    libs.setdefault(parts[1], []).append(i)
+        isas = {}
         for abi in self.abis:
+            if abi not in libs:
+                continue
             if abi not in abis:
-                lib_dir = os.path.join(d, 'lib', abi)
-                if os.path.exists(lib_dir):
-                    shutil.rmtree(lib_dir)
-                    logger.info("ABI " + abi + ' is not wanted, removed')
-            elif abi in self.abi2isa:
-                isa = self.abi2isa[abi]
+                logger.info("ABI %s is not wanted, skip", abi)
+                continue
+            isa = self.abi2isa.get(abi, abi)
+            if isa in isas.values():
+                logger.debug("the target ISA is already deployed, skip %s", abi)
+                continue
+            isas[abi] = isa
+        # the unknown ones are deployed as they are
+        for abi in libs:
+            if abi not in self.abis:
+                logger.warning("ABI %s is not supported, keep it as is", abi)
+                isas[abi] = abi
+        return libs, isas
+
+    def _deploy_lib(self, zf, d, abis):
+        libs, isas = self._plan_lib(zf, abis)
+        if not isas:
+            return True
+        lib_dir = os.path.join(d, 'lib')
+        patterns = ['lib/{}/*'.format(abi) for abi in isas]
+        if unzip_lib(zf.filename, d, patterns):
+            # convert ABI to ISA, one rename for each
+            for abi, isa in isas.items():
                 if abi != isa:
-                    abi_dir = os.path.join(d, 'lib', abi)
-                    isa_dir = os.path.join(d, 'lib', isa)
-                    if os.path.exists(abi_dir):
-                        if os.path.exists(isa_dir):
-                            logger.debug(
-                                "the target ISA is already deployed, skip " + abi)
-                        else:
-                            os.rename(abi_dir, isa_dir)
-            else:
-                logger.warning("ABI " + abi + ' is not supported, skip')
+                    to = os.path.join(lib_dir, isa)
+                    # left by a broken deployment before, replace it
+                    try:
+                        shutil.rmtree(to)
+                    except FileNotFoundError:
+                        pass
+                    os.rename(os.path.join(lib_dir, abi), to)
+            return True
+        # extract to the ISA dir directly, no rename afterwards
+        jobs = []
+        for abi, isa in isas.items():
+            for i in libs[abi]:
+                rest = i.filename.split('/', 2)[2]
+                jobs.append((i, os.path.join(lib_dir, isa, rest)))
+        # create each dir once, rather than once for each file in it
+        for p in {os.path.dirname(path) for _, path in jobs}:
+            os.makedirs(p, exist_ok=True)
+        # in the order of the data in the file to keep reading forward
+        jobs.sort(key=lambda j: j[0].header_offset)
+        # inflating releases the GIL, and the reads on the shared file
+        # are serialized by ZipFile itself, so extract them in parallel
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            list(ex.map(lambda j: self._extract(zf, *j), jobs))
         return True
 
     def get_info(self, name):
         self._ensure_index()
-        if name in self.index:
-            return self.index[name]
+        return self.index.get(name)
+
+    def _load_index_cache(self, key):
+        try:
+            with open(self.index_cache, 'rb') as f:
+                cache = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.debug("ignore the broken index cache: %s", e)
+            return
+        if cache.get('key') == key:
+            self.index = cache['index']
+            self.index_loaded = True
+            return True
+
+    def _save_index_cache(self, key):
+        cache = dict(key=key, index=self.index)
+        try:
+            with open(self.index_cache, 'wb') as f:
+                pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            logger.debug("can't save the index cache: %s", e)
+
+    def _drop_index_cache(self):
+        try:
+            os.unlink(self.index_cache)
+        except FileNotFoundError:
+            pass
+
+    def _get_haystack(self):
+        # only search needs it, not worth loading it for the others
+        if self.haystack is None:
+            # the fields in lower case for the plain text, searched one by
+            # one, so a text never matches across two of them
+            self.haystack = {
+                n: (n.lower(), i.get('title', '').lower(),
+                    i.get('path', '').lower())
+                for n, i in self.index.items()}
+        return self.haystack
+
+    def _get_sorted_names(self):
+        if self.sorted_names is None:
+            pairs = sorted((n.lower(), n) for n in self.index)
+            self.sorted_names = ([k for k, _ in pairs], [n for _, n in pairs])
+        return self.sorted_names
 
     def _load_index(self):
-        if os.path.exists(self.index_file):
-            with open(self.index_file, 'r') as f:
-                info, raw_info = {}, json.load(f)
-                for item in raw_info:
-                    name = '-'.join([item['package'], item['version']])
-                    info[name] = item
-                self.index = info
-                return True
+        self.haystack = None
+        self.sorted_names = None
+        try:
+            st = os.stat(self.index_file)
+        except FileNotFoundError:
+            return
+        # reuse the parsed one if the index is not changed since then
+        key = (INDEX_CACHE_VERSION, st.st_mtime_ns, st.st_size)
+        if self._load_index_cache(key):
+            return True
+        with open(self.index_file, 'rb') as f:
+            # stream the items if possible, no need to hold the whole list
+            if ijson:
+                raw_info = ijson.items(f, 'item', use_float=True,
+                                       buf_size=1024 * 1024)
+            elif orjson:
+                raw_info = orjson.loads(f.read())
+            else:
+                raw_info = json.load(f)
+            index = {f"{i['package']}-{i['version']}": i for i in raw_info}
+        # sorted by name once here, so is any subset iterated in order
+        self.index = dict(sorted(index.items(), key=itemgetter(0)))
+        self.index_loaded = True
+        self._save_index_cache(key)
+        return True
 
     def clean(self):
-        if os.path.exists(self.cache_dir):
-            # move the index to the root dir to prevent it from being deleted
-            # and move back later
-            m = os.path.join(self.root_dir, os.path.basename(self.index_file))
-            try:
-                os.rename(self.index_file, m)
-                shutil.rmtree(self.cache_dir)
-            finally:
-                self._ensure_dirs()
-                os.rename(m, self.index_file)
+        try:
+            it = os.scandir(self.cache_dir)
+        except FileNotFoundError:
+            return True
+        with it:
+            # delete everything but the index
+            for entry in it:
+                if entry.path == self.index_file:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
         return True
 
     def update(self):
         self._ensure_dirs()
+        # keep the current one until the new one is downloaded completely
+        tmp = self.index_file + '.tmp'
         try:
-            with urlopen(self.index_url) as res:
-                with open(self.index_file, 'w') as f:
-                    f.write(res.read().decode('utf-8'))
+            with self._urlopen(self.index_url) as res:
+                # keep the bytes as they are, and never hold all of them
+                with open(tmp, 'wb') as f:
+                    copy_stream(res, f)
+            os.replace(tmp, self.index_file)
         except URLError as e:
-            logger.warning('error to download ' +
-                           self.index_url + ': ' + str(e))
+            logger.warning('error to download %s: %s', self.index_url, e)
             return
+        finally:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+        # the mtime may be too coarse to tell it is changed, drop it anyway
+        self._drop_index_cache()
         return self._load_index()
 
     def _get_latest(self, names):
@@ -277,81 +648,276 @@ class Repo:
             latest[p] = dict(name=n, vercode=i['vercode'])
         return [v['name'] for v in latest.values()]
 
-    def search(self, pattern='.', name_only=False, latest=False, installed=False):
+    def search(self, pattern='.', name_only=False, latest=False, installed=False,
+               status=True):
+        # status: add the cached and installed status to the results,
+        # not needed when only the names are wanted
         self._ensure_index()
-        pat = re.compile(pattern, flags=re.I)
-        names = []
-        for name, info in self.index.items():
-            # search name first
-            m = pat.search(name)
-            if m:
-                names.append(name)
-                continue
-            # search the other fields
-            if not name_only:
-                for f in ("title", "path"):
-                    m = pat.search(info[f])
-                    if m:
-                        names.append(name)
-                        break
-
-        result = []
-        for n in sorted(names):
-            i = dict(cached=self.is_cached(n), installed=self.is_installed(n))
-            if installed and not i['installed']:
-                continue
-            i.update(self.get_info(n))
-            result.append((n, i))
+        prefix = pattern[1:]
+        if name_only and pattern[:1] == '^' and re.escape(prefix) == prefix:
+            # plain prefix of the name, find the range in the sorted names
+            keys, names = self._get_sorted_names()
+            prefix = prefix.lower()
+            lo = bisect_left(keys, prefix)
+            hi = bisect_right(keys, prefix + '\U0010ffff', lo)
+            matches = [(n, self.index[n]) for n in names[lo:hi]]
+            matches.sort(key=itemgetter(0))
+        elif pattern in ('', '.'):
+            # the default one, e.g. list all, matches any of them
+            matches = list(self.index.items())
+        else:
+            # plain text, no need of the regex engine
+            text = pattern.lower() if re.escape(pattern) == pattern else None
+            pat = compile_pattern(pattern) if text is None else None
+            # search name only, or name with the other fields, each field
+            # on its own, the locals save the attribute lookups for each apk;
+            # the regex runs on the fields as they are, re.I is for the case,
+            # the lower case ones are for the plain text only, so the inline
+            # flags like (?-i:...) still work
+            index = self.index
+            if pat is not None:
+                search = pat.search
+                if name_only:
+                    matches = [(n, i) for n, i in index.items() if search(n)]
+                else:
+                    matches = [(n, i) for n, i in index.items()
+                               if search(n) or search(i.get('title', '')) or
+                               search(i.get('path', ''))]
+            elif name_only:
+                matches = [(n, i) for n, i in index.items()
+                           if text in n.lower()]
+            else:
+                hay = self._get_haystack().items()
+                matches = [(n, index[n]) for n, (name, title, path) in hay
+                           if text in name or text in title or text in path]
+
+        if status:
+            result = []
+            installed_names = self._installed_names()
+            for n, info in matches:
+                is_installed = n in installed_names
+                if installed and not is_installed:
+                    continue
+                # the same check as install, but with the cached digest,
+                # a listing reads only the apks changed since they were
+                # verified
+                i = dict(cached=self._is_cached(info, read=False),
+                         installed=is_installed)
+                i.update(info)
+                result.append((n, i))
+        elif installed:
+            installed_names = self._installed_names()
+            result = [m for m in matches if m[0] in installed_names]
+        else:
+            result = matches
         if latest:
             wanted = {k: 1 for k in self._get_latest(n for n, _ in result)}
             result = [i for i in result if i[0] in wanted]
         return result
 
-    def installed(self, pattern='.', name_only=False, latest=False):
-        return self.search(pattern, name_only=name_only, latest=latest, installed=True)
+    def installed(self, pattern='.', name_only=False, latest=False, status=True):
+        return self.search(pattern, name_only=name_only, latest=latest,
+                           installed=True, status=status)
 
     def install(self, name, reinstall=False, abis=['all']):
+        import zipfile
+
         if 'all' in abis:
             abis = self.abis[:]
 
         self._ensure_dirs()
         path = self._get_cached(name)
-        logger.debug("install " + name + " from " + str(path))
+        logger.debug("install %s from %s", name, path)
         if path:
             if self.is_installed(name):
                 if reinstall:
                     self.uninstall(name, force=True)
                 else:
-                    logger.warning(name + " has already been installed")
+                    logger.warning("%s has already been installed", name)
                     return
 
-            to = self._installed_path(name)
-            self._ensure_parent_dir(to)
-            os.link(path, to)
-            return self._deploy_lib(to, abis)
+            # open it before linking, a broken one won't be half installed
+            with zipfile.ZipFile(path) as zf:
+                to = self._installed_path(name)
+                self._ensure_parent_dir(to)
+                clone_file(path, to)
+                return self._deploy_lib(zf, os.path.dirname(to), abis)
         else:
-            logger.warning("can't find: " + name)
+            logger.warning("can't find: %s", name)
 
     def uninstall(self, name, force=False):
         path = self._installed_path(name)
-        logger.debug("uninstall " + name + " at " + path)
-        if os.path.exists(path):
-            shutil.rmtree(os.path.dirname(path))
-            return True
-        elif force:
+        logger.debug("uninstall %s at %s", name, path)
+        # the name is a dir right in the installed dir, never anything else,
+        # e.g. "", "." or "..", which would remove the parent dirs
+        if (name not in ('', '.', '..') and os.sep not in name and
+                not (os.altsep and os.altsep in name) and
+                name in self._installed_names()):
+            try:
+                shutil.rmtree(os.path.dirname(path))
+                return True
+            except FileNotFoundError:
+                pass
+        if force:
             return True
-        else:
-            logger.warning("can't find: " + path)
+        logger.warning("can't find: %s", path)
 
     def download(self, name, force=False):
         self._ensure_dirs()
         if force and self.is_cached(name):
-            logger.debug(name + "is cached, unlink first")
+            logger.debug("%s is cached, unlink first", name)
             os.unlink(self._cached_path(name))
         if self._get_cached(name):
             return True
 
 
+def copy_stream(src, dst, size=1024 * 1024, bar=None, hasher=None):
+    # read into the same buffer, no new bytes object for each chunk,
+    # dst may be None to hash the src only
+    buf = memoryview(bytearray(size))
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            break
+        if dst:
+            dst.write(buf[:n])
+        if hasher:
+            hasher.update(buf[:n])
+        if bar:
+            bar.next(n)
+
+
+# the cached digest of a file, see file_sha256
+XATTR_SHA256 = 'user.apk-get.sha256'
+
+
+def file_sha256(path, read=True):
+    """Get the SHA-256 digest of the file in hex
+
+    The digest is cached in an extended attribute along with the mtime,
+    so it is computed once until the file is changed. If read is False,
+    the file is read only if it is changed since then, None is returned
+    if it has never been cached
+    """
+    mtime = os.stat(path).st_mtime_ns
+    changed = False
+    try:
+        cached = os.getxattr(path, XATTR_SHA256).decode().split()
+        if cached[0] == str(mtime):
+            return cached[1]
+        changed = True
+    except (AttributeError, OSError, IndexError):
+        # not supported by the platform or the file system, or not cached
+        pass
+    if not read and not changed:
+        return None
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        copy_stream(f, None, hasher=h)
+    digest = h.hexdigest()
+    save_sha256(path, digest, mtime)
+    return digest
+
+
+def save_sha256(path, digest, mtime=None):
+    # cache the digest for file_sha256, keyed by the mtime of the file
+    if mtime is None:
+        mtime = os.stat(path).st_mtime_ns
+    try:
+        os.setxattr(path, XATTR_SHA256, '{} {}'.format(mtime, digest).encode())
+    except (AttributeError, OSError):
+        pass
+
+
+# the validator of the remote file a .part is downloaded from
+XATTR_VALIDATOR = 'user.apk-get.validator'
+
+
+def get_validator(headers):
+    # for If-Range, which takes a strong ETag or the Last-Modified date
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def load_validator(path):
+    try:
+        return os.getxattr(path, XATTR_VALIDATOR).decode()
+    except (AttributeError, OSError):
+        return None
+
+
+def save_validator(path, validator):
+    try:
+        os.setxattr(path, XATTR_VALIDATOR, validator.encode())
+    except (AttributeError, OSError):
+        pass
+
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+# see also: linux/fs.h
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """Make dst share the data of src without copying if possible
+
+    Try reflink first on the file systems support it, e.g. btrfs and XFS,
+    with copy on write either one can be changed safely, then hard link,
+    at last copy it
+    """
+    if fcntl:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError as e:
+                logger.debug("can't clone %s: %s", src, e)
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        # only the cases a copy can help, e.g. not the same file system
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                           errno.EOPNOTSUPP):
+            raise
+        logger.debug("can't link %s: %s", src, e)
+    shutil.copyfile(src, dst)
+
+
+@functools.lru_cache(maxsize=None)
+def find_unzip():
+    return shutil.which('unzip')
+
+
+def unzip_lib(apk, d, patterns=['lib/*']):
+    """Extract the native libs of the apk into d by the unzip command
+
+    It is much faster than zipfile for the apks with lots of libs,
+    return False if it is not available or fails
+    """
+    unzip = find_unzip()
+    if not unzip:
+        return False
+    import subprocess
+    cmd = [unzip, '-qo', apk] + patterns + ['-d', d]
+    logger.debug('run: %s', ' '.join(cmd))
+    r = subprocess.run(cmd, stdin=subprocess.DEVNULL)
+    # 1 is for warnings only, e.g. unsafe path components are skipped
+    if r.returncode > 1:
+        logger.warning("unzip %s failed: %d", apk, r.returncode)
+        return False
+    return True
+
+
 @contextmanager
 def cd(newdir):
     prevdir = os.getcwd()
@@ -364,7 +930,10 @@ def cd(newdir):
 
 @contextmanager
 def new_server(address, handler):
-    httpd = HTTPServer(address, handler)
+    from http.server import ThreadingHTTPServer
+
+    # one slow client won't block the others
+    httpd = ThreadingHTTPServer(address, handler)
     try:
         yield httpd
     finally:
@@ -376,9 +945,17 @@ def serve_dir(directory, bind='', port=3000):
 
     It is not recommended for production
     """
+    from http.server import SimpleHTTPRequestHandler
+
+    class Handler(SimpleHTTPRequestHandler):
+        def copyfile(self, source, outputfile):
+            # let the kernel copy the file to the socket if it can
+            outputfile.flush()
+            self.connection.sendfile(source)
+
     address = (bind, port)
     with cd(directory):
-        with new_server(address, SimpleHTTPRequestHandler) as httpd:
+        with new_server(address, Handler) as httpd:
             sa = httpd.socket.getsockname()
             msg = "Serving HTTP on http://{host}:{port} for {root} ..."
             print(msg.format(host=sa[0], port=sa[1], root=directory))
@@ -388,33 +965,41 @@ def serve_dir(directory, bind='', port=3000):
                 sys.exit(0)
 
 
+def need_status(pretty='default', format=None):
+    # the short one shows the names only, user defined one may use any
+    return bool(format) or pretty not in ['s', 'short']
+
+
 def show_apks(apk_info, pretty='default', format=None):
     # user defined format has the higher priority
+    write = sys.stdout.write
     if format:
         for name, info in apk_info:
-            print(format.format(**info, name=name))
+            write(format.format(**info, name=name) + '\n')
         return
 
     # and then the predefined format
     if pretty in ['s', 'short']:
         for name, _ in apk_info:
-            print(name)
+            write(name + '\n')
     elif pretty in ['v', 'verbose']:
         width = None
         for name, info in apk_info:
             if width is None:
-                width = max(list(map(len, info.keys()))) + 1
-            print(name + ":")
-            for k in sorted(info.keys()):
-                print("  {k:{w}} {v!s}".format(k=k+':', v=info[k], w=width))
-            print('')
+                width = max(map(len, info)) + 1
+            # one write for each apk rather than each field
+            lines = [name + ':']
+            for k in sorted(info):
+                lines.append("  {k:{w}} {v!s}".format(k=k+':', v=info[k], w=width))
+            lines.append('\n')
+            write('\n'.join(lines))
     else:
+        line = "{:48} {:2} {:28}\n".format
         for name, info in apk_info:
             stat = 'c' if info['cached'] else ' '
             if info['installed']:
                 stat = stat + 'i'
-            print("{n:48} {s:2} {t:28}".format(
-                n=name, s=stat, t=info['title']))
+            write(line(name, stat, info['title']))
 
 
 def parse_args():
@@ -454,6 +1039,8 @@ def parse_args():
     p.add_argument('-a', '--abis', help='abis separated by ","', default='all')
     p.add_argument('-r', '--reinstall', action='store_true',
                    help='reinstall if necessary')
+    p.add_argument('-j', '--jobs', help='apks to install at the same time',
+                   type=int, default=8)
     p = subps.add_parser(
         'uninstall', help='uninstall apk', formatter_class=fmt)
     p.add_argument('name', help='apk name or "all"', nargs='+')
@@ -464,6 +1051,8 @@ def parse_args():
     p.add_argument('name', help='apk name or "all"', nargs='+')
     p.add_argument('-f', '--force', action='store_true',
                    help='download even if already cached')
+    p.add_argument('-j', '--jobs', help='apks to download at the same time',
+                   type=int, default=8)
     p = subps.add_parser(
         'serve', help='serve the cache as a remote repository', formatter_class=fmt)
     p.add_argument('-p', '--port', help='port number', type=int, default=3000)
@@ -475,14 +1064,53 @@ def parse_args():
 
 def expand_name(repo, name, installed=False):
     if not repo.get_info(name):
-        info = repo.search(name, name_only=True,
-                           latest=True, installed=installed)
+        info = repo.search(name, name_only=True, latest=True,
+                           installed=installed, status=False)
         # only expand name when only one result
         if len(info) == 1:
             name, _ = info[0]
     return name
 
 
+def run_parallel(func, names, jobs=8):
+    """Call func for each of the names in parallel
+
+    The network and disk I/O overlap, the results are yielded in the same
+    order as the names. At most jobs of them run at the same time, the next
+    one is only started after one succeeds, so it stops at the first
+    failure, the ones already started are finished and yielded too
+    """
+    # the same one should never be processed at the same time
+    names = list(dict.fromkeys(names))
+    jobs = max(1, jobs)
+    with ThreadPoolExecutor(max_workers=jobs) as ex:
+        futures = []
+        running = set()
+
+        def start():
+            if len(futures) < len(names):
+                f = ex.submit(func, names[len(futures)])
+                futures.append(f)
+                running.add(f)
+
+        for _ in range(jobs):
+            start()
+        failed = False
+        i = 0
+        while i < len(futures):
+            # wait for the next one in order, start a new one for each done
+            while futures[i] in running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in done:
+                    running.discard(f)
+                    if failed or f.exception() or not f.result():
+                        failed = True
+                    else:
+                        start()
+            yield names[i], futures[i].result()
+            i += 1
+
+
 def main():
     args = parse_args()
     repo = Repo(index_url=args.index, root_dir=args.root)
@@ -499,24 +1127,36 @@ def main():
             print("update fail")
             sys.exit(1)
     elif args.cmd == 'search':
-        result = repo.search(pattern=args.pattern)
+        status = need_status(args.pretty, args.format)
+        result = repo.search(pattern=args.pattern, status=status)
         show_apks(result, pretty=args.pretty, format=args.format)
     elif args.cmd == 'list':
-        result = repo.installed(pattern=args.pattern)
+        status = need_status(args.pretty, args.format)
+        result = repo.installed(pattern=args.pattern, status=status)
         show_apks(result, pretty=args.pretty, format=args.format)
     elif args.cmd == 'install':
         abis = [abi.strip() for abi in args.abis.split(',')]
-        for name in args.name:
-            name = expand_name(repo, name)
-            if repo.install(name, reinstall=args.reinstall, abis=abis):
+        names = [expand_name(repo, n) for n in args.name]
+        install = functools.partial(
+            repo.install, reinstall=args.reinstall, abis=abis)
+        # the bars of the parallel ones would overwrite each other on one
+        # line, the result line of each is shown instead
+        if args.jobs > 1 and len(names) > 1:
+            repo.progress_file = None
+        repo.jobs = args.jobs
+        failed = False
+        for name, ok in run_parallel(install, names, args.jobs):
+            if ok:
                 print("install " + name + " success")
             else:
                 print("install " + name + " fail")
-                sys.exit(1)
+                failed = True
+        if failed:
+            sys.exit(1)
     elif args.cmd == 'uninstall':
         names = args.name
         if 'all' in args.name:
-            names = [name for name, _ in repo.installed()]
+            names = [name for name, _ in repo.installed(status=False)]
         else:
             names = [expand_name(repo, n, installed=True) for n in names]
         for name in names:
@@ -528,15 +1168,24 @@ def main():
     elif args.cmd == 'download':
         names = args.name
         if 'all' in args.name:
-            names = [name for name, _ in repo.search()]
+            names = [name for name, _ in repo.search(status=False)]
         else:
             names = [expand_name(repo, n) for n in names]
-        for name in names:
-            if repo.download(name, force=args.force):
+        download = functools.partial(repo.download, force=args.force)
+        # the bars of the parallel ones would overwrite each other on one
+        # line, the result line of each is shown instead
+        if args.jobs > 1 and len(names) > 1:
+            repo.progress_file = None
+        repo.jobs = args.jobs
+        failed = False
+        for name, ok in run_parallel(download, names, args.jobs):
+            if ok:
                 print("download " + name + " success")
             else:
                 print("download " + name + " fail")
-                sys.exit(1)
+                failed = True
+        if failed:
+            sys.exit(1)
     elif args.cmd == 'serve':
         serve_dir(repo.cache_dir, bind=args.bind, port=args.port)
     else:
@@ -2,19 +2,21 @@
 # author: joe.zheng
 
 import argparse
-import copy
+import hashlib
 import logging
 import subprocess
 import re
 import sys
 import json
 import os
-from string import Template
+import stat
+from concurrent.futures import ThreadPoolExecutor
 
-# hack here to ensure the current locale supports unicode correctly
-import locale
-if locale.getpreferredencoding() != 'UTF-8':
-    locale.setlocale(locale.LC_CTYPE, 'en_US.UTF-8')
+try:
+    # optional, to dump the index faster
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -41,132 +43,21 @@ parser.add_argument("-d", "--delete-old", action='store_true',
 parser.add_argument("path", help="apk file or directory", nargs="+")
 
 
-def sh(cmd):
-    logger.debug('sh: ' + ' '.join(cmd))
-    return subprocess.check_output(cmd, universal_newlines=True)
+# for the output of 'aapt d badging', compiled once for all the apks, one
+# pass for each line, the name of the group tells which one is matched
+RE_BADGING = re.compile(
+    r"application-label(?:-en)?(?:-US)?:\s*(?P<label>.+)$"
+    r"|application:\s*label='(?P<app>[^']+)'"
+    r"|package:\s*(?P<package>.+)$"
+    r"|launchable-activity:\s*(?P<launchable>.+)$"
+    r"|native-code:\s*(?P<native>.+)$")
+# most of the lines are none of them, reject those without the regex
+BADGING_KEYS = ('application', 'package:', 'launchable-activity:',
+                'native-code:')
 
 
-def get_aapt_version():
-    logger.debug('get_aapt_version')
-    cmd = ['aapt', 'v']
-    try:
-        l = sh(cmd).splitlines()[0]
-        m = re.match(r'Android Asset Packaging Tool,\s*(.+)$', l.rstrip())
-        if m:
-            return m.group(1)
-    except Exception as e:
-        logger.error(e)
-
-
-def clean(s):
-    return s.strip().strip("'")
-
-
-def get_apk_info(path):
-    logger.debug('get_apk_info: ' + path)
-
-    info = {'launchable': [], 'jnilib': []}
-    info['size'] = os.path.getsize(path)
-
-    cmd = ['aapt', 'd', 'badging', path]
-    for l in sh(cmd).splitlines():
-        if not 'title' in info:
-            m = re.match(r"application-label(?:-en)?(?:-US)?:\s*(.+)$", l)
-            if m:
-                info['title'] = clean(m.group(1))
-                continue
-
-        m = re.match(r"application:\s*label='([^']+)'", l)
-        if m:
-            info['title'] = clean(m.group(1))
-            continue
-
-        m = re.match(r"package:\s*(.+)$", l)
-        if m:
-            for attr in re.split(r'\s+', m.group(1)):
-                try:
-                    k, v = attr.split('=', 2)
-                    if k == 'name':
-                        info['package'] = clean(v)
-                        continue
-                    elif k == 'versionName':
-                        info['version'] = clean(v)
-                        continue
-                    elif k == 'versionCode':
-                        info['vercode'] = clean(v)
-                        continue
-                except ValueError:
-                    logger.warning('fail to parse, skip: ' + attr)
-                    continue
-            continue
-
-        # TODO: add "leanback-launchable-activity" to support TV
-        m = re.match(r"launchable-activity:\s*(.+)$", l)
-        if m:
-            for attr in re.split(r'\s+', m.group(1)):
-                k, v = attr.split('=', 2)
-                if k == 'name':
-                    info['launchable'].append(clean(v))
-                    # enough for us to get one
-                    break
-            continue
-
-        m = re.match(r"native-code:\s*(.+)$", l)
-        if m:
-            for abi in re.split(r'\s+', m.group(1)):
-                v = clean(abi)
-                if v:
-                    info['jnilib'].append(v)
-            continue
-
-    logger.debug(json.dumps(info, sort_keys=True, ensure_ascii=False))
-    return info
-
-
-def is_apk(path):
-    logger.debug('is_apk: ' + path)
-    return True if os.path.splitext(path)[1].lower() == '.apk' else False
-
-
-def find_apk(paths):
-    logger.debug('find_apk: ' + str(paths))
-    for p in paths:
-        logger.info('processing ' + p)
-        if not os.path.exists(p):
-            logger.warning('no such path, skip: ' + p)
-            continue
-        if os.path.isfile(p):
-            if is_apk(p):
-                logger.debug('found apk: ' + p)
-                yield p
-        elif os.path.isdir(p):
-            for root, _, files in os.walk(p):
-                for f in files:
-                    if is_apk(f):
-                        logger.debug('found apk: ' + f)
-                        yield os.path.join(root, f)
-
-
-def save_index(meta, path):
-    logger.debug('save_index: ' + path)
-
-    data_file = 'index.json'
-    html_file = 'index.html'
-
-    data = []
-    for name in sorted(meta.keys()):
-        d = copy.copy(meta[name])
-        for k, v in d.items():
-            # list is not easy to be saved into csv, so convert it into a string
-            if isinstance(v, list):
-                d[k] = ', '.join(v)
-        data.append(d)
-
-    json_data = json.dumps(data, sort_keys=True, ensure_ascii=False, indent=4)
-    with open(os.path.join(path, data_file), 'w') as f:
-        f.write(json_data)
-
-    tmpl = '''<!doctype html>
+# the page to browse the index, split at $data where the index is put
+HTML_HEAD, HTML_TAIL = (s.encode('utf-8') for s in '''<!doctype html>
 <html lang="en">
 
 <head>
@@ -238,10 +129,204 @@ def save_index(meta, path):
 </body>
 
 </html>
-    '''
+    '''.split('$data'))
+
+
+def sh(cmd):
+    logger.debug('sh: %s', ' '.join(cmd))
+    return subprocess.check_output(cmd, encoding='utf-8')
+
+
+def sh_lines(cmd):
+    # parse the output while the command is still running, line by line
+    logger.debug('sh: %s', ' '.join(cmd))
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, encoding='utf-8') as p:
+        yield from p.stdout
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
+def get_aapt_version():
+    logger.debug('get_aapt_version')
+    cmd = ['aapt', 'v']
+    try:
+        l = sh(cmd).splitlines()[0]
+        m = re.match(r'Android Asset Packaging Tool,\s*(.+)$', l.rstrip())
+        if m:
+            return m.group(1)
+    except Exception as e:
+        logger.error(e)
+
+
+def get_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for b in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(b)
+    return h.hexdigest()
+
+
+def clean(s):
+    return s.strip().strip("'")
+
+
+def get_apk_info(path):
+    logger.debug('get_apk_info: %s', path)
+
+    info = {'launchable': [], 'jnilib': []}
+    info['size'] = os.path.getsize(path)
+    # for the client to verify the downloaded one
+    info['sha256'] = get_sha256(path)
+
+    cmd = ['aapt', 'd', 'badging', path]
+    for l in sh_lines(cmd):
+        if not l.startswith(BADGING_KEYS):
+            continue
+        m = RE_BADGING.match(l)
+        if not m:
+            continue
+        kind, value = m.lastgroup, m.group(m.lastgroup)
+
+        if kind == 'label':
+            if not 'title' in info:
+                info['title'] = clean(value)
+
+        elif kind == 'app':
+            info['title'] = clean(value)
+
+        elif kind == 'package':
+            for attr in value.split():
+                try:
+                    k, v = attr.split('=', 1)
+                    if k == 'name':
+                        info['package'] = clean(v)
+                        continue
+                    elif k == 'versionName':
+                        info['version'] = clean(v)
+                        continue
+                    elif k == 'versionCode':
+                        info['vercode'] = clean(v)
+                        continue
+                except ValueError:
+                    logger.warning('fail to parse, skip: %s', attr)
+                    continue
+
+        # TODO: add "leanback-launchable-activity" to support TV
+        elif kind == 'launchable':
+            for attr in value.split():
+                k, v = attr.split('=', 1)
+                if k == 'name':
+                    info['launchable'].append(clean(v))
+                    # enough for us to get one
+                    break
+
+        elif kind == 'native':
+            for abi in value.split():
+                v = clean(abi)
+                if v:
+                    info['jnilib'].append(v)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(info, sort_keys=True, ensure_ascii=False))
+    return info
+
+
+def is_apk(path):
+    # called for every file found, keep it cheap
+    return path[-4:].lower() == '.apk'
+
+
+def walk_apk(top):
+    # similar with os.walk, but only the apks are kept, checked by the name
+    # of each entry as it is listed
+    try:
+        it = os.scandir(top)
+    except OSError as e:
+        logger.warning('fail to list, skip: %s', e)
+        return
+    apks, subdirs = [], []
+    with it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                # do not follow the links to the dirs, as os.walk
+                if not entry.is_symlink():
+                    subdirs.append(entry.path)
+            elif is_apk(entry.name):
+                apks.append(entry.path)
+    for p in apks:
+        logger.debug('found apk: %s', p)
+        yield p
+    for d in subdirs:
+        yield from walk_apk(d)
+
+
+def find_apk(paths):
+    logger.debug('find_apk: %s', paths)
+    # the same apk can be given more than once, e.g. "x.apk x.apk" or a dir
+    # and an apk in it, it's gone after being renamed the first time
+    seen = set()
+    for p in paths:
+        logger.info('processing %s', p)
+        # one stat for all the checks
+        try:
+            mode = os.stat(p).st_mode
+        except FileNotFoundError:
+            logger.warning('no such path, skip: %s', p)
+            continue
+        except OSError as e:
+            # e.g. no permission, a loop of links or not a dir in the path
+            logger.warning('fail to access, skip: %s', e)
+            continue
+        if stat.S_ISREG(mode):
+            if not is_apk(p):
+                continue
+            logger.debug('found apk: %s', p)
+            apks = [p]
+        elif stat.S_ISDIR(mode):
+            apks = walk_apk(p)
+        else:
+            continue
+        for apk in apks:
+            try:
+                st = os.lstat(apk)
+            except OSError as e:
+                logger.warning('fail to access, skip: %s', e)
+                continue
+            key = (st.st_dev, st.st_ino)
+            if key in seen:
+                logger.debug('already found, skip: %s', apk)
+                continue
+            seen.add(key)
+            yield apk
+
+
+def save_index(meta, path):
+    logger.debug('save_index: %s', path)
+
+    data_file = 'index.json'
+    html_file = 'index.html'
+
+    # list is not easy to be saved into csv, so convert it into a string
+    data = [{k: ', '.join(v) if isinstance(v, list) else v
+             for k, v in meta[name].items()} for name in sorted(meta)]
+
+    # indented by 2, the only width orjson supports, the same either way;
+    # encoded once, the page embeds the same bytes
+    if orjson:
+        json_data = orjson.dumps(
+            data, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2)
+    else:
+        json_data = json.dumps(data, sort_keys=True, ensure_ascii=False,
+                               indent=2).encode('utf-8')
+    with open(os.path.join(path, data_file), 'wb') as f:
+        f.write(json_data)
 
-    with open(os.path.join(path, html_file), 'w') as f:
-        f.write(Template(tmpl).substitute(data=json_data))
+    with open(os.path.join(path, html_file), 'wb') as f:
+        f.writelines([HTML_HEAD, json_data, HTML_TAIL])
 
 
 def main():
@@ -256,24 +341,28 @@ def main():
         out = args.root
         delete_old = args.delete_old
         latest_pkg = {}
-        for src in find_apk(args.path):
-            logger.info('processing apk: ' + src)
-            info = get_apk_info(src)
-            name = '-'.join([info[k] for k in ['package', 'version']]) + '.apk'
+        paths = list(find_apk(args.path))
+        # aapt runs in its own process, so threads are enough to run
+        # several of them at once, the results are still in order
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            infos = list(ex.map(get_apk_info, paths))
+        for src, info in zip(paths, infos):
+            logger.info('processing apk: %s', src)
+            name = f"{info['package']}-{info['version']}.apk"
             dst = os.path.join(os.path.dirname(src), name)
 
             if name in seen:
                 old = seen[name]
-                logger.warning('duplicated one, already found {}'.format(old))
+                logger.warning('duplicated one, already found %s', old)
                 os.unlink(src)
                 os.symlink(os.path.relpath(old, os.path.dirname(dst)), dst)
-                logger.info('replaced with link: {}'.format(dst))
+                logger.info('replaced with link: %s', dst)
             else:
                 if src == dst:
                     logger.info('no need to rename')
                 else:
-                    os.rename(src, dst)
-                    logger.info('renamed to ' + dst)
+                    os.replace(src, dst)
+                    logger.info('renamed to %s', dst)
 
                 pkg = info['package']
                 if delete_old and pkg in latest_pkg:
@@ -281,14 +370,12 @@ def main():
                     if info['vercode'] > latest['vercode']:
                         old = latest['name']
                         path = seen[old]
-                        logger.info(
-                            'new verison, delete old one: {}'.format(path))
+                        logger.info('new verison, delete old one: %s', path)
                         os.unlink(path)
                         del meta[old]
                         del seen[old]
                     else:
-                        logger.info(
-                            'old version, delete and skip: {}'.format(dst))
+                        logger.info('old version, delete and skip: %s', dst)
                         os.unlink(dst)
                         continue
 
@@ -299,7 +386,7 @@ def main():
                 # add path relative to the index file
                 info['path'] = os.path.relpath(dst, start=out)
 
-        logger.info('save index to ' + out)
+        logger.info('save index to %s', out)
         save_index(meta, out)
 
 
@@ -0,0 +1,57 @@
+import importlib.util
+import os
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script(name):
+    # the scripts are not a package, and the dash is not allowed in a module
+    path = os.path.join(ROOT, 'script', name)
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+apk_get = load_script('apk-get.py')
+
+
+class RunParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.called = []
+        self.lock = threading.Lock()
+
+    def func(self, name):
+        with self.lock:
+            self.called.append(name)
+        return name != 'nosuch'
+
+    def test_stop_at_first_failure_with_one_job(self):
+        names = ['nosuch', 'com.foo-1.0', 'com.bar-1.0']
+        results = list(apk_get.run_parallel(self.func, names, jobs=1))
+        self.assertEqual(results, [('nosuch', False)])
+        self.assertEqual(self.called, ['nosuch'])
+
+    def test_keep_order(self):
+        names = [f'com.foo-{i}' for i in range(10)]
+        results = list(apk_get.run_parallel(self.func, names, jobs=4))
+        self.assertEqual(results, [(n, True) for n in names])
+
+    def test_skip_duplicates(self):
+        names = ['com.foo-1.0', 'com.bar-1.0', 'com.foo-1.0']
+        results = list(apk_get.run_parallel(self.func, names, jobs=2))
+        self.assertEqual(results, [('com.foo-1.0', True),
+                                   ('com.bar-1.0', True)])
+
+    def test_raise_error(self):
+        def func(name):
+            raise OSError(name)
+
+        with self.assertRaises(OSError):
+            list(apk_get.run_parallel(func, ['com.foo-1.0'], jobs=2))
+
+
+if __name__ == '__main__':
+    unittest.main()